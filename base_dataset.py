@@ -3,16 +3,18 @@
 
 
 import os
+import itertools
 import logging
 import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict, Generator, Tuple, List
 from abc import ABC, abstractmethod
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.dataset import Dataset
 from tqdm import tqdm
-from transformers import PreTrainedTokenizer, torch_distributed_zero_first
-from transformers import default_data_collator
+from transformers import AutoTokenizer, PreTrainedTokenizer, torch_distributed_zero_first
 
 from arguments import DataTrainingArguments
 from input_example import InputFeatures, InputExample
@@ -20,6 +22,19 @@ from input_formats import INPUT_FORMATS
 from output_formats import OUTPUT_FORMATS, key2ind, ind2key
 
 
+# precomputed decode strings (index -> 'token '), with 0 (padding) mapped to '',
+# so decode_new is a single join instead of per-token dict lookups and f-strings
+_DECODE_TABLE = {0: ''}
+_DECODE_TABLE.update({ind: f'{key} ' for ind, key in ind2key.items()})
+
+
+def stack_collator(features: List[dict]) -> dict:
+    """
+    Collate features whose fields are already tensors by stacking each field.
+    """
+    return {key: torch.stack([f[key] for f in features]) for key in features[0]}
+
+
 class BaseDataset(Dataset, ABC):
     """
     Base class for all datasets.
@@ -32,6 +47,12 @@ class BaseDataset(Dataset, ABC):
     default_output_format = None
     default_data_dir = 'data'
 
+    feature_fields = ('input_ids', 'attention_mask', 'labels', 'boundary_ids')
+
+    # subclasses whose load_data_single_split is thread-safe (no shared random state
+    # or file writes) can opt in to loading multiple splits concurrently
+    parallel_load = False
+
     def __init__(
             self,
             tokenizer: PreTrainedTokenizer,
@@ -51,6 +72,13 @@ class BaseDataset(Dataset, ABC):
             random.seed(seed)
 
         self.data_args = data_args
+
+        if not tokenizer.is_fast:
+            # fast (Rust) tokenizers encode whole batches in parallel without holding the GIL,
+            # which is what makes the single batched call in compute_features worthwhile
+            logging.info(f'Replacing {tokenizer.__class__.__name__} with its fast (Rust) version')
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer.name_or_path, use_fast=True)
+        assert tokenizer.is_fast
         self.tokenizer = tokenizer
 
         self.max_input_length = max_input_length
@@ -74,11 +102,14 @@ class BaseDataset(Dataset, ABC):
             f"{'_multitask' if data_args.multitask else ''}.pth"
         )
 
+        self.cached_data_file = cached_data_file
+        self._examples = None  # loaded lazily, see the examples property
+
         with torch_distributed_zero_first(local_rank):
             # make sure only the first process in distributed training processes the dataset,
             # and the others can use the cached version
 
-            if os.path.exists(cached_data_file) and not overwrite_cache:
+            if self._cache_is_complete(cached_data_file) and not overwrite_cache:
                 self.load_cached_data(cached_data_file)
 
             else:
@@ -89,24 +120,34 @@ class BaseDataset(Dataset, ABC):
                 for example in self.examples:
                     example.dataset = self
 
-                self.features = self.compute_features(
+                self._set_features(self.compute_features(
                     max_input_length=max_input_length,
                     max_output_length=max_output_length,
                     multitask=data_args.multitask,
-                )
+                ))
 
                 if local_rank in [-1, 0]:
                     # save data
                     self.save_data(cached_data_file)
 
-            # shuffle indices
-            self.indices = list(range(len(self.examples)))
+            # shuffle indices (the feature tensors give the dataset size without
+            # forcing the lazy examples to be loaded)
+            num_examples = len(self.input_ids)
             if seed is not None and shuffle:
-                random.shuffle(self.indices)
+                # vectorized C shuffle; the dedicated generator keeps the permutation
+                # reproducible without consuming the global random stream
+                g = torch.Generator()
+                g.manual_seed(seed)
+                self.indices = torch.randperm(num_examples, generator=g)
+            else:
+                self.indices = torch.arange(num_examples)
 
-            # compute effective size of the dataset
-            self.effective_size = round(train_subset * len(self.examples))
-            if train_subset != 1:
+            # compute effective size of the dataset; the full-dataset case bypasses the
+            # float multiply/round entirely so the size is exact
+            if train_subset == 1:
+                self.effective_size = num_examples
+            else:
+                self.effective_size = round(train_subset * num_examples)
                 logging.info(f"Effective dataset size reduced to {self.effective_size} ({train_subset * 100:.0f}%)")
 
     def __repr__(self):
@@ -116,10 +157,49 @@ class BaseDataset(Dataset, ABC):
         return self.effective_size
 
     def __getitem__(self, i: int) -> dict:
-        return self.features[self.indices[i]]
+        j = int(self.indices[i])
+        # zero-copy row views into the SoA feature tensors
+        return {
+            'input_ids': self.input_ids[j],
+            'attention_mask': self.attn_mask[j],
+            'labels': self.labels[j],
+            'boundary_ids': self.boundary_ids[j],
+        }
+
+    def get_batch(self, idxs: torch.Tensor) -> dict:
+        """
+        Gather a whole batch of features with a single index_select per field.
+        """
+        rows = self.indices[idxs]
+        return {
+            'input_ids': self.input_ids.index_select(0, rows),
+            'attention_mask': self.attn_mask.index_select(0, rows),
+            'labels': self.labels.index_select(0, rows),
+            'boundary_ids': self.boundary_ids.index_select(0, rows),
+        }
 
     def get_example(self, i: int) -> InputExample:
-        return self.examples[self.indices[i]]
+        return self.examples[int(self.indices[i])]
+
+    @property
+    def examples(self) -> List[InputExample]:
+        """
+        The raw examples, loaded lazily: training only touches the feature tensors,
+        so the pickled examples are read back only when evaluation first needs them.
+        """
+        if self._examples is None:
+            # the sidecar is a locally written, trusted cache of InputExample objects;
+            # weights_only unpickling (the default on recent torch) would reject them
+            self._examples = torch.load(self._examples_file(self.cached_data_file),
+                                        weights_only=False)['examples']
+            # the back-reference is excluded from the pickle, so reattach it here
+            for example in self._examples:
+                example.dataset = self
+        return self._examples
+
+    @examples.setter
+    def examples(self, value: List[InputExample]):
+        self._examples = value
 
     def data_dir(self):
         if self.data_name is not None:
@@ -127,15 +207,66 @@ class BaseDataset(Dataset, ABC):
         else:
             return os.path.join(self.data_path, self.name)
 
+    def _set_features(self, features: Dict[str, torch.Tensor]):
+        # keep the SoA tensors under self.features (for serialization) and as
+        # direct attributes for row slicing in __getitem__
+        self.features = features
+        self.input_ids = features['input_ids']
+        self.attn_mask = features['attention_mask']
+        self.labels = features['labels']
+        self.boundary_ids = features['boundary_ids']
+
+    @staticmethod
+    def _feature_file(cached_data_file: str, field: str) -> str:
+        return f'{cached_data_file}.{field}.npy'
+
+    @staticmethod
+    def _examples_file(cached_data_file: str) -> str:
+        return f'{cached_data_file}.examples'
+
+    def _cache_is_complete(self, cached_data_file: str) -> bool:
+        """
+        Check that the whole cache is present: the marker/metadata file, the
+        per-field .npy feature files, and the examples sidecar. A pre-existing
+        single-file cache from the old format (or a partially written one) fails
+        this check and is rebuilt instead of crashing in _load_features.
+        """
+        files = [cached_data_file, self._examples_file(cached_data_file)]
+        files += [self._feature_file(cached_data_file, field) for field in self.feature_fields]
+        return all(os.path.exists(f) for f in files)
+
+    def _save_examples(self, cached_data_file: str):
+        # protocol 5 pickles large buffers out-of-band, which is markedly faster to
+        # write and to read back than the default protocol; torch's weights-only
+        # unpickler cannot parse protocol-5 streams, so the matching load in the
+        # examples property must keep weights_only=False
+        torch.save({'examples': self.examples}, self._examples_file(cached_data_file),
+                   pickle_protocol=5, _use_new_zipfile_serialization=True)
+
+    def _save_features(self, cached_data_file: str):
+        # one .npy file per field, so that load_cached_data can memory-map them
+        for field in self.feature_fields:
+            np.save(self._feature_file(cached_data_file, field), self.features[field].numpy())
+
+    def _load_features(self, cached_data_file: str):
+        # memory-map the cached tensors: only the rows that are actually touched get
+        # paged in, and multiple DDP ranks share the pages through the OS page cache
+        self._set_features({
+            field: torch.from_numpy(np.load(self._feature_file(cached_data_file, field), mmap_mode='r'))
+            for field in self.feature_fields
+        })
+
     def load_cached_data(self, cached_data_file: str):
-        d = torch.load(cached_data_file)
-        self.examples, self.features = d['examples'], d['features']
+        # only the feature tensors are needed up front; the examples stay on disk
+        # until the examples property is first accessed
+        self._load_features(cached_data_file)
 
     def save_data(self, cached_data_file: str):
-        torch.save({
-            'examples': self.examples,
-            'features': self.features,
-        }, cached_data_file)
+        self._save_features(cached_data_file)
+        self._save_examples(cached_data_file)
+        # the main cache file carries any remaining metadata and doubles as the
+        # cache-existence marker checked in __init__
+        torch.save({}, cached_data_file)
 
     def load_schema(self):
         """
@@ -150,25 +281,50 @@ class BaseDataset(Dataset, ABC):
         """
         pass
 
+    @staticmethod
+    def _parallel_map_examples(build_example_fn, raw_records, n_workers: int = None,
+                               chunksize: int = 128) -> List[InputExample]:
+        """
+        Fan per-record example construction out over a process pool.
+
+        build_example_fn must be a picklable module-level callable whose work is
+        independent per record (no shared random state or file writes); the order
+        of raw_records is preserved. Intended for load_data_single_split
+        implementations whose per-record preprocessing is CPU-bound.
+        """
+        with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+            return list(executor.map(build_example_fn, raw_records, chunksize=chunksize))
+
     def load_data(self, mode: str, seed: int = None) -> List[InputExample]:
         """
         Load all data, where 'mode' is a list of comma-separated splits to use.
         """
-        examples = []
-
         if isinstance(mode, str):
             splits = mode.split(',')
         else:
             assert isinstance(mode, (list, tuple))
             splits = mode
 
-        for split in splits:
-            examples += self.load_data_single_split(split, seed=seed)
+        if self.parallel_load and len(splits) > 1:
+            # overlap disk reads and tokenization across splits: the fast tokenizer
+            # releases the GIL, so threads give real concurrency here
+            with ThreadPoolExecutor(max_workers=len(splits)) as executor:
+                results = list(executor.map(lambda split: self.load_data_single_split(split, seed=seed), splits))
+            return list(itertools.chain.from_iterable(results))
 
-        return examples
+        # flatten all splits into one list in a single pass
+        return list(itertools.chain.from_iterable(
+            self.load_data_single_split(split, seed=seed) for split in splits
+        ))
 
     def _warn_max_sequence_length(self, max_sequence_length: int, sentences: List[str], name: str):
-        max_length_needed = max(len(self.tokenizer.tokenize(x)) for x in sentences)
+        # a single batched call so that the fast tokenizer can process all sentences in
+        # parallel; return_length gives the counts without materializing token strings,
+        # and counting the special tokens matches what padding to max_length needs
+        lengths = self.tokenizer(
+            sentences, add_special_tokens=True, return_length=True, padding=False, truncation=False
+        )['length']
+        max_length_needed = max(lengths)
         if max_length_needed > max_sequence_length:
             logging.warning(
                 f'Max sequence length is {max_sequence_length} but the longest {name} sequence is '
@@ -177,14 +333,20 @@ class BaseDataset(Dataset, ABC):
 
     @staticmethod
     def batch_encode_output_(output_index, max_output_length):
-        input_ids = []
-        attention_mask = []
-        for ins in output_index:
-            input_ids.append(ins + (max_output_length - len(ins)) * [0])
-            attention_mask.append(len(ins) * [1] + (max_output_length - len(ins)) * [0])
-        input_ids = torch.tensor(input_ids, dtype=torch.int64)
-        attention_mask = torch.tensor(attention_mask, dtype=torch.int64)
-        output_tok = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        # vectorized padding: scatter all sequences into a zero matrix in one shot
+        # instead of building a padded Python list per row
+        lengths = np.fromiter((len(ins) for ins in output_index), dtype=np.int64, count=len(output_index))
+        valid = np.arange(max_output_length) < lengths[:, None]
+        input_ids = np.zeros((len(output_index), max_output_length), dtype=np.int64)
+        input_ids[valid] = np.fromiter(
+            itertools.chain.from_iterable(output_index), dtype=np.int64, count=int(lengths.sum())
+        )
+        # from_numpy wraps the existing int64 buffers zero-copy, whereas torch.tensor
+        # would walk and copy every element again
+        output_tok = {
+            'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': torch.from_numpy(valid.astype(np.int64)),
+        }
         return output_tok
 
     def tokenize_function(self, examples, max_length: int):
@@ -197,17 +359,23 @@ class BaseDataset(Dataset, ABC):
         )
 
     def compute_features(self, max_input_length: int, max_output_length: int, multitask: bool = False):
-        output_sentences = []
-        if self.data_args.output_format_type == 'short-relation':
-            output_sentences = [self.output_format.format_short_output_with_relation(example) for example in
-                                self.examples]
-        elif self.data_args.output_format_type == 'short':
-            output_sentences = [self.output_format.format_short_output(example) for example in self.examples]
-        elif self.data_args.output_format_type == 'long':
-            output_sentences = [self.output_format.format_long_output(example) for example in self.examples]
-        elif self.data_args.output_format_type == 'original':
-            output_sentences = [self.output_format.format_short_output_(example) for example in self.examples]
-        boundary_sentences = [' '.join(example.boundary_tokens) for example in self.examples]
+        # the output format is fixed per dataset, so resolve the formatter once and
+        # map it over the examples instead of re-evaluating the branch per list comp
+        output_formatters = {
+            'short-relation': self.output_format.format_short_output_with_relation,
+            'short': self.output_format.format_short_output,
+            'long': self.output_format.format_long_output,
+            'original': self.output_format.format_short_output_,
+        }
+        formatter = output_formatters.get(self.data_args.output_format_type)
+        output_sentences = list(map(formatter, self.examples)) if formatter is not None else []
+        # the boundary sentence is precomputed at load time; join on the fly only for
+        # examples built before the field existed
+        boundary_sentences = [
+            example.boundary_sentence if example.boundary_sentence is not None
+            else ' '.join(example.boundary_tokens)
+            for example in self.examples
+        ]
 
         # if self.data_args.boundary_in_where == 'Encoder':
         #     logging.info("Boundary information is added to the end of the input sequence and used in Encoder.")
@@ -218,24 +386,67 @@ class BaseDataset(Dataset, ABC):
         input_sentences = [self.input_format.format_input(example, multitask=multitask) for example in
                            self.examples]
 
-        features = []
-        for input_sentence, output_sentence in zip(input_sentences, output_sentences):
-            features.append({
-                "input_sentence": input_sentence,
-                "output_sentence": output_sentence
-            })
-        return features
+        self._warn_max_sequence_length(max_input_length, input_sentences, "input")
+        self._warn_max_sequence_length(max_output_length, output_sentences, "output")
+
+        # tokenize each list of sentences with a single batched call: the fast tokenizer
+        # runs multithreaded in Rust, instead of crossing into Python once per example
+        input_tok = self.tokenizer(
+            input_sentences,
+            max_length=max_input_length,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt',
+        )
+        output_tok = self.tokenizer(
+            output_sentences,
+            max_length=max_output_length,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt',
+        )
+        boundary_tok = self.tokenizer(
+            boundary_sentences,
+            max_length=max_input_length,
+            padding='max_length',
+            truncation=True,
+            return_tensors='pt',
+        )
+
+        # structure-of-arrays layout: one contiguous tensor per field, so that
+        # __getitem__ can hand out row views without any per-item allocation
+        return {
+            'input_ids': input_tok['input_ids'],
+            'attention_mask': input_tok['attention_mask'],
+            'labels': output_tok['input_ids'],
+            'boundary_ids': boundary_tok['input_ids'],
+        }
 
     @staticmethod
     def decode_new(prediction):
-        prediction = prediction.tolist()
-        string = ""
-        for pre in prediction:
-            if pre == 0:
-                pass
-            else:
-                string += f'{ind2key[pre]} '
-        return string
+        return ''.join(map(_DECODE_TABLE.__getitem__, prediction.tolist()))
+
+    @staticmethod
+    def _prefetch(it, device, copy_stream=None):
+        """
+        Pull the next batch from the data loader iterator and start its H2D copy.
+        Returns None when the iterator is exhausted.
+        """
+        try:
+            inputs = next(it)
+        except StopIteration:
+            return None
+
+        if copy_stream is not None:
+            # issue the copies on a side stream so they overlap with generation
+            copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(copy_stream):
+                inputs['input_ids'] = inputs['input_ids'].to(device, non_blocking=True)
+                inputs['boundary_ids'] = inputs['boundary_ids'].to(device, non_blocking=True)
+        else:
+            inputs['input_ids'] = inputs['input_ids'].to(device, non_blocking=True)
+            inputs['boundary_ids'] = inputs['boundary_ids'].to(device, non_blocking=True)
+        return inputs
 
     def generate_output_sentences(self, data_args: DataTrainingArguments, model, device, batch_size: int, features) \
             -> Generator[Tuple[InputExample, str], None, None]:
@@ -246,41 +457,56 @@ class BaseDataset(Dataset, ABC):
             self,
             batch_size=batch_size,
             shuffle=False,
-            collate_fn=default_data_collator,
+            collate_fn=stack_collator,
+            num_workers=max(2, os.cpu_count() // 2),
+            pin_memory=True,
+            persistent_workers=True,
+            prefetch_factor=4,
         )
-        # total = len(test_data_loader)
-        for i, inputs in tqdm(enumerate(test_data_loader), total=len(test_data_loader)):
+        # double-buffered prefetch: the H2D copy of batch i+1 is issued before
+        # model.generate runs on batch i, so the PCIe copy hides behind generation
+        copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        it = iter(test_data_loader)
+        inputs = self._prefetch(it, device, copy_stream)
+        progress = tqdm(total=len(test_data_loader))
+        i = 0
+        while inputs is not None:
+            if copy_stream is not None:
+                # make sure the current batch's copy has finished before generating
+                torch.cuda.current_stream().wait_stream(copy_stream)
+            next_inputs = self._prefetch(it, device, copy_stream)
+
             if data_args.boundary_in_where == 'Encoder':
                 predictions = model.generate(
-                    inputs['input_ids'].to(device),
+                    inputs['input_ids'],
                     max_length=data_args.max_output_seq_length_eval,
                     num_beams=data_args.num_beams
                 )
             elif data_args.boundary_in_where == 'Decoder':
                 predictions = model.generate(
-                    inputs['input_ids'].to(device),
+                    inputs['input_ids'],
                     max_length=data_args.max_output_seq_length_eval,
                     num_beams=data_args.num_beams,
                     features=inputs['boundary_ids']
                 )
 
-            for j, (input_ids, label_ids, prediction) in enumerate(
-                    zip(inputs['input_ids'], inputs['labels'], predictions)):
-                if data_args.boundary_in_where == 'Encoder':
-                    current_id = i * batch_size + j
-                    example = self.get_example(current_id)
-                    # output_sentence = self.decode_new(prediction)
-                    # pre_list = prediction.tolist()
-                    output_sentence = self.tokenizer.decode(prediction, skip_special_tokens=True,
-                                                            clean_up_tokenization_spaces=False)
-                elif data_args.boundary_in_where == 'Decoder':
-                    current_id = i * batch_size + j
-                    example = self.get_example(current_id)
-                    output_sentence = self.tokenizer.decode(prediction[51:], skip_special_tokens=True,
-                                                            clean_up_tokenization_spaces=False)
-
+            if data_args.boundary_in_where == 'Decoder':
+                # strip the boundary prefix while predictions are still on the GPU
+                predictions = predictions[:, 51:]
+            # one async D2H copy for the whole batch instead of a row-by-row sync
+            predictions = predictions.to('cpu', non_blocking=True)
+            # one batched Rust call instead of a tokenizer.decode per example
+            decoded = self.tokenizer.batch_decode(predictions, skip_special_tokens=True,
+                                                  clean_up_tokenization_spaces=False)
+            for j, output_sentence in enumerate(decoded):
+                example = self.get_example(i * batch_size + j)
                 yield example, output_sentence, None
 
+            inputs = next_inputs
+            i += 1
+            progress.update(1)
+        progress.close()
+
     @abstractmethod
     def evaluate_dataset(self, data_args: DataTrainingArguments, model, device, batch_size: int, macro: bool = False) \
             -> Dict[str, float]:
@@ -453,17 +453,21 @@ class JointERDataset(BaseDataset):
     default_output_format = 'joint_er'
 
     def load_cached_data(self, cached_features_file):
-        d = torch.load(cached_features_file)
-        self.entity_types, self.relation_types, self.examples, self.features = \
-            d['entity_types'], d['relation_types'], d['examples'], d['features']
+        # trusted local cache holding EntityType/RelationType objects, which the
+        # weights-only unpickler (the default on recent torch) refuses to load
+        d = torch.load(cached_features_file, weights_only=False)
+        self.entity_types, self.relation_types = d['entity_types'], d['relation_types']
+        self._load_features(cached_features_file)
 
     def save_data(self, cached_features_file):
+        self._save_features(cached_features_file)
+        self._save_examples(cached_features_file)
+        # protocol 5 is unreadable by torch's weights-only unpickler, so the matching
+        # load_cached_data must keep weights_only=False
         torch.save({
             'entity_types': self.entity_types,
             'relation_types': self.relation_types,
-            'examples': self.examples,
-            'features': self.features,
-        }, cached_features_file)
+        }, cached_features_file, pickle_protocol=5, _use_new_zipfile_serialization=True)
 
     def load_schema(self):
         """
@@ -793,6 +797,7 @@ class FloorplanDataset(JointERDataset):
                         rooms=rooms,
                         boundary=boundary,
                         boundary_tokens=boundary_tokens,
+                        boundary_sentence=' '.join(boundary_tokens),
                         editing_rooms=editing_rooms,
                         image_id=description['img_id']
                     )
@@ -803,6 +808,7 @@ class FloorplanDataset(JointERDataset):
                         rooms=rooms,
                         boundary=boundary,
                         boundary_tokens=boundary_tokens,
+                        boundary_sentence=' '.join(boundary_tokens),
                         editing_rooms=editing_rooms
                     )
 
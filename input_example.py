@@ -8,7 +8,7 @@ from typing import List, Optional, Any, Dict, Union
 from torch.utils.data.dataset import Dataset
 
 
-@dataclass
+@dataclass(slots=True)
 class EntityType:
     """
     An entity type in a dataset.
@@ -20,7 +20,7 @@ class EntityType:
         return hash(self.short)
 
 
-@dataclass
+@dataclass(slots=True)
 class RelationType:
     """
     A relation type in a dataset.
@@ -32,7 +32,7 @@ class RelationType:
         return hash(self.short)
 
 
-@dataclass
+@dataclass(slots=True)
 class Entity:
     """
     An entity in a training/test example.
@@ -49,7 +49,7 @@ class Entity:
         return hash((self.id, self.start, self.end))
 
 
-@dataclass
+@dataclass(slots=True)
 class Relation:
     """
     An (asymmetric) relation in a training/test example.
@@ -62,7 +62,7 @@ class Relation:
         return self.type.natural, self.head.to_tuple(), self.tail.to_tuple()
 
 
-@dataclass
+@dataclass(slots=True)
 class Intent:
     """
     The intent of an utterance.
@@ -74,12 +74,12 @@ class Intent:
         return hash(self.short)
 
 
-@dataclass
+@dataclass(slots=True)
 class RoomType:
     natural: str = None  # string to use in input/output sentences
 
 
-@dataclass
+@dataclass(slots=True)
 class Room:
     type: RoomType  # the specific room type
     # start: int                  # start index in the description to the room
@@ -104,7 +104,7 @@ class Room:
     private: str = None  # whether the room (i.e. balcony, bathroom, bedroom is private)
 
 
-@dataclass
+@dataclass(slots=True)
 class InputExample:
     """
     A single training/test example.
@@ -116,6 +116,7 @@ class InputExample:
     rooms: List[Room] = None  # list of rooms
     boundary: List[tuple] = None  # list of boundary pixels ([(x,y),(x1,y1),(x2,y2)...])
     boundary_tokens: List[str] = None  # list of tokens (words) describing the boundary
+    boundary_sentence: str = None  # ' '.join(boundary_tokens), precomputed at load time
     editing_rooms: List[dict] = None  # list of dropped rooms and their correspondin dropped attributes
     image_id: str = None  # unique image id
 
@@ -140,8 +141,20 @@ class InputExample:
     belief_state: Union[Dict[str, Any], str] = None
     utterance_tokens: str = None
 
+    def __getstate__(self):
+        # drop the dataset back-reference when pickling: it would drag the whole
+        # dataset (tokenizer included) into the cache and create a reference cycle
+        state = {slot: getattr(self, slot) for slot in self.__slots__}
+        state['dataset'] = None
+        return state
 
-@dataclass
+    def __setstate__(self, state):
+        # the dataset reference stays None; the owning dataset reattaches itself
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+
+@dataclass(slots=True)
 class CorefDocument:
     """
     A document for the coreference resolution task.
@@ -154,7 +167,7 @@ class CorefDocument:
     groups: List[List[Entity]]  # coreference groups
 
 
-@dataclass
+@dataclass(slots=True)
 class InputFeatures:
     """
     A single set of features of data.